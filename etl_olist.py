@@ -1,14 +1,38 @@
 import logging
 import sys
 import os
+import io
+import json
+import shutil
 import requests
 import zipfile
 import yaml
-from pyspark.sql import SparkSession, DataFrame
-from pyspark.sql.functions import col, monotonically_increasing_id, to_date, year, month, dayofmonth, quarter, dayofweek, date_format, udf, count, lit, avg, stddev, min, max
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, DataFrame, Column
+from pyspark.sql.functions import col, xxhash64, to_date, year, month, dayofmonth, quarter, dayofweek, date_format, count, lit, avg, stddev, min, max, initcap, regexp_replace, coalesce, broadcast, when, countDistinct, struct
 from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType, TimestampType, FloatType
 from typing import Dict, List
 
+FILE_MAP = {
+    "customers": "olist_customers_dataset.csv",
+    "sellers": "olist_sellers_dataset.csv",
+    "products": "olist_products_dataset.csv",
+    "orders": "olist_orders_dataset.csv",
+    "order_items": "olist_order_items_dataset.csv",
+    "translation": "product_category_name_translation.csv",
+    "geolocation": "olist_geolocation_dataset.csv"
+}
+
+NEEDED_COLUMNS = {
+    "customers": ["customer_id", "customer_unique_id", "customer_zip_code_prefix", "customer_city", "customer_state"],
+    "sellers": ["seller_id", "seller_zip_code_prefix", "seller_city", "seller_state"],
+    "products": ["product_id", "product_category_name", "product_photos_qty"],
+    "orders": ["order_id", "customer_id", "order_status", "order_purchase_timestamp"],
+    "order_items": ["order_id", "product_id", "seller_id", "price", "freight_value"],
+    "translation": ["product_category_name", "product_category_name_english"],
+    "geolocation": ["geolocation_zip_code_prefix", "geolocation_lat", "geolocation_lng"]
+}
+
 class AdvancedStarSchemaPipeline:
     def __init__(self, config_path: str):
         self.config = self._load_config(config_path)
@@ -28,12 +52,19 @@ class AdvancedStarSchemaPipeline:
         logging.getLogger("pyspark").setLevel(logging.WARNING)
 
     def _initialize_spark(self) -> SparkSession:
+        shuffle_partitions = (os.cpu_count() or 1) * 2
         try:
             return (
                 SparkSession.builder
                 .appName(self.config["spark"]["app_name"])
                 .master(self.config["spark"]["master"])
                 .config("spark.sql.legacy.timeParserPolicy", "LEGACY")
+                .config("spark.sql.adaptive.enabled", "true")
+                .config("spark.sql.adaptive.coalescePartitions.enabled", "true")
+                .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m")
+                .config("spark.sql.shuffle.partitions", shuffle_partitions if shuffle_partitions > 8 else 8)
+                .config("spark.sql.execution.arrow.pyspark.enabled", "true")
+                .config("spark.sql.csv.parser.columnPruning.enabled", "true")
                 .getOrCreate()
             )
         except Exception as e:
@@ -47,16 +78,15 @@ class AdvancedStarSchemaPipeline:
             return
 
         os.makedirs(source_path, exist_ok=True)
-        zip_path = os.path.join(source_path, "olist_dataset.zip")
         try:
             self.logger.info(f"Baixando dados de {self.config['data']['url']}...")
             response = requests.get(self.config["data"]["url"], stream=True, timeout=60)
             response.raise_for_status()
-            with open(zip_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192): f.write(chunk)
-            
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref: zip_ref.extractall(source_path)
-            os.remove(zip_path)
+            response.raw.decode_content = True
+            buffer = io.BytesIO()
+            shutil.copyfileobj(response.raw, buffer, length=1 << 20)
+
+            with zipfile.ZipFile(buffer, 'r') as zip_ref: zip_ref.extractall(source_path)
             self.logger.info("Download e descompactação concluídos.")
         except Exception as e:
             self.logger.critical(f"Falha no download ou descompactação dos dados: {e}", exc_info=True)
@@ -65,68 +95,98 @@ class AdvancedStarSchemaPipeline:
     def _load_source_tables(self, schemas: Dict[str, StructType]):
         self.logger.info("Carregando tabelas de origem...")
         source_path = self.config["data"]["source_path"]
+        parquet_path = os.path.join(source_path, "parquet")
         for name, schema in schemas.items():
-            file_path = f"{source_path}/olist_{name.replace('_', '_dataset_')}.csv"
-            self.source_tables[name] = self.spark.read.csv(file_path, header=True, schema=schema)
+            file_path = f"{source_path}/{FILE_MAP[name]}"
+            table_path = os.path.join(parquet_path, f"{name}.parquet")
+            if self._is_parquet_cache_stale(table_path, file_path, schema):
+                self.logger.info(f"Convertendo {file_path} para Parquet...")
+                self.spark.read.csv(file_path, header=True, schema=schema).write.mode("overwrite").parquet(table_path, compression="snappy")
+            self.source_tables[name] = self.spark.read.parquet(table_path).select(*NEEDED_COLUMNS[name])
+        self.source_tables["orders"] = self.source_tables["orders"].withColumn("order_purchase_date", to_date("order_purchase_timestamp"))
+
+    def _is_parquet_cache_stale(self, table_path: str, file_path: str, schema: StructType) -> bool:
+        success_path = os.path.join(table_path, "_SUCCESS")
+        if not os.path.exists(success_path): return True
+        if os.path.exists(file_path) and os.path.getmtime(file_path) > os.path.getmtime(success_path): return True
+        cached_schema = self.spark.read.parquet(table_path).schema
+        return [(f.name, f.dataType) for f in cached_schema] != [(f.name, f.dataType) for f in schema]
 
     def _create_dimensions(self):
         self.logger.info("Iniciando a criação das tabelas de dimensão...")
-        self.dimensional_models["Dim_Geolocalizacao"] = self._create_dim_geolocalizacao()
-        self.dimensional_models["Dim_Cliente"] = self._create_dim_cliente()
-        self.dimensional_models["Dim_Produto"] = self._create_dim_produto()
-        self.dimensional_models["Dim_Vendedor"] = self._create_dim_vendedor()
-        self.dimensional_models["Dim_Tempo"] = self._create_dim_tempo()
+        self.dimensional_models["Dim_Geolocalizacao"] = self._persist_model(self._create_dim_geolocalizacao())
+        self.dimensional_models["Dim_Cliente"] = self._persist_model(self._create_dim_cliente())
+        self.dimensional_models["Dim_Produto"] = self._persist_model(self._create_dim_produto())
+        self.dimensional_models["Dim_Vendedor"] = self._persist_model(self._create_dim_vendedor())
+        self.dimensional_models["Dim_Tempo"] = self._persist_model(self._create_dim_tempo())
+
+    def _persist_model(self, df: DataFrame) -> DataFrame:
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
+        df.count()
+        return df
+
+    def _unpersist_models(self):
+        for df in self.dimensional_models.values():
+            df.unpersist()
     
     def _create_dim_geolocalizacao(self) -> DataFrame:
-        df_geo = self.source_tables["geolocation"].groupBy("geolocation_zip_code_prefix").agg(
+        df_geo = self.source_tables["geolocation"].where(col("geolocation_zip_code_prefix").isNotNull()).groupBy("geolocation_zip_code_prefix").agg(
             avg("geolocation_lat").alias("latitude"),
             avg("geolocation_lng").alias("longitude")
         )
-        return df_geo.withColumn("id_geolocalizacao", monotonically_increasing_id())
+        return df_geo.withColumn("id_geolocalizacao", xxhash64("geolocation_zip_code_prefix"))
 
     def _create_dim_cliente(self) -> DataFrame:
         df_customers = self.source_tables["customers"]
         df_geo = self.dimensional_models["Dim_Geolocalizacao"]
-        dim_cliente = df_customers.join(df_geo, df_customers.customer_zip_code_prefix == df_geo.geolocation_zip_code_prefix, "left") \
+        dim_cliente = df_customers.join(broadcast(df_geo), df_customers.customer_zip_code_prefix == df_geo.geolocation_zip_code_prefix, "left") \
             .select(
                 col("customer_unique_id").alias("id_negocio_cliente"),
                 col("customer_city").alias("cidade_cliente"),
                 col("customer_state").alias("estado_cliente"),
                 col("id_geolocalizacao")
-            ).distinct()
-        return dim_cliente.withColumn("id_cliente", monotonically_increasing_id())
+            ).groupBy("id_negocio_cliente").agg(
+                min(struct(col("id_geolocalizacao").isNull().alias("sem_geolocalizacao"), "cidade_cliente", "estado_cliente", "id_geolocalizacao")).alias("endereco")
+            ).select("id_negocio_cliente", "endereco.cidade_cliente", "endereco.estado_cliente", "endereco.id_geolocalizacao")
+        return dim_cliente.withColumn("id_cliente", xxhash64("id_negocio_cliente"))
 
     def _create_dim_produto(self) -> DataFrame:
         df_products = self.source_tables["products"]
         df_translation = self.source_tables["translation"]
-        capitalize_udf = udf(lambda s: s.replace("_", " ").title() if s else "N/A", StringType())
         dim_produto = df_products.join(df_translation, "product_category_name", "left").select(
             col("product_id").alias("id_negocio_produto"),
-            capitalize_udf(col("product_category_name_english")).alias("categoria_produto"),
+            coalesce(initcap(regexp_replace(col("product_category_name_english"), "_", " ")), lit("N/A")).alias("categoria_produto"),
             col("product_photos_qty")
-        ).distinct()
-        return dim_produto.withColumn("id_produto", monotonically_increasing_id())
+        ).groupBy("id_negocio_produto").agg(min(struct("categoria_produto", "product_photos_qty")).alias("atributos")) \
+            .select("id_negocio_produto", "atributos.categoria_produto", "atributos.product_photos_qty")
+        return dim_produto.withColumn("id_produto", xxhash64("id_negocio_produto"))
 
     def _create_dim_vendedor(self) -> DataFrame:
         df_sellers = self.source_tables["sellers"]
         df_geo = self.dimensional_models["Dim_Geolocalizacao"]
-        dim_vendedor = df_sellers.join(df_geo, df_sellers.seller_zip_code_prefix == df_geo.geolocation_zip_code_prefix, "left") \
+        dim_vendedor = df_sellers.join(broadcast(df_geo), df_sellers.seller_zip_code_prefix == df_geo.geolocation_zip_code_prefix, "left") \
             .select(
                 col("seller_id").alias("id_negocio_vendedor"),
                 col("seller_city").alias("cidade_vendedor"),
                 col("seller_state").alias("estado_vendedor"),
                 col("id_geolocalizacao")
-            ).distinct()
-        return dim_vendedor.withColumn("id_vendedor", monotonically_increasing_id())
+            ).groupBy("id_negocio_vendedor").agg(
+                min(struct(col("id_geolocalizacao").isNull().alias("sem_geolocalizacao"), "cidade_vendedor", "estado_vendedor", "id_geolocalizacao")).alias("endereco")
+            ).select("id_negocio_vendedor", "endereco.cidade_vendedor", "endereco.estado_vendedor", "endereco.id_geolocalizacao")
+        return dim_vendedor.withColumn("id_vendedor", xxhash64("id_negocio_vendedor"))
 
     def _create_dim_tempo(self) -> DataFrame:
         df_orders = self.source_tables["orders"]
-        date_df = df_orders.select(to_date(col("order_purchase_timestamp")).alias("data")).distinct().na.drop()
+        date_df = df_orders.select(col("order_purchase_date").alias("data")).distinct().na.drop()
         dim_tempo = date_df.select(
             col("data"), year("data").alias("ano"), month("data").alias("mes"), dayofmonth("data").alias("dia"),
             quarter("data").alias("trimestre"), date_format("data", "E").alias("nome_dia_semana")
         )
-        return dim_tempo.withColumn("id_tempo", monotonically_increasing_id())
+        return dim_tempo.withColumn("id_tempo", self._date_key("data"))
+
+    @staticmethod
+    def _date_key(date_column: str) -> Column:
+        return year(date_column) * 10000 + month(date_column) * 100 + dayofmonth(date_column)
 
     def _create_fact_table(self):
         self.logger.info("Iniciando a criação da tabela Fato_Vendas...")
@@ -134,48 +194,54 @@ class AdvancedStarSchemaPipeline:
         df_orders = self.source_tables["orders"]
         df_customers = self.source_tables["customers"]
 
-        base_fato = df_items.join(df_orders, "order_id", "inner").join(df_customers.select("customer_id", "customer_unique_id"), "customer_id", "inner")
-        
+        base_fato = df_items.join(df_orders, "order_id", "inner").join(broadcast(df_customers.select("customer_id", "customer_unique_id")), "customer_id", "inner")
+        base_fato = base_fato.withColumn("chave_data", self._date_key("order_purchase_date"))
+
+        dim_produto = self.dimensional_models["Dim_Produto"]
+        dim_cliente = self.dimensional_models["Dim_Cliente"]
+        dim_vendedor = self.dimensional_models["Dim_Vendedor"]
+        dim_tempo = self.dimensional_models["Dim_Tempo"]
         fato_com_chaves = base_fato \
-            .join(self.dimensional_models["Dim_Produto"], base_fato.product_id == self.dimensional_models["Dim_Produto"].id_negocio_produto, "left") \
-            .join(self.dimensional_models["Dim_Cliente"], base_fato.customer_unique_id == self.dimensional_models["Dim_Cliente"].id_negocio_cliente, "left") \
-            .join(self.dimensional_models["Dim_Vendedor"], base_fato.seller_id == self.dimensional_models["Dim_Vendedor"].id_negocio_vendedor, "left") \
-            .join(self.dimensional_models["Dim_Tempo"], to_date(base_fato.order_purchase_timestamp) == self.dimensional_models["Dim_Tempo"].data, "left")
+            .join(broadcast(dim_produto), base_fato.product_id == dim_produto.id_negocio_produto, "left") \
+            .join(broadcast(dim_cliente), base_fato.customer_unique_id == dim_cliente.id_negocio_cliente, "left") \
+            .join(broadcast(dim_vendedor), base_fato.seller_id == dim_vendedor.id_negocio_vendedor, "left") \
+            .join(broadcast(dim_tempo), base_fato.chave_data == dim_tempo.id_tempo, "left")
         
-        self.dimensional_models["Fato_Vendas"] = fato_com_chaves.select(
+        self.dimensional_models["Fato_Vendas"] = self._persist_model(fato_com_chaves.select(
             col("id_produto"), col("id_cliente"), col("id_vendedor"), col("id_tempo"),
             col("order_id").alias("id_pedido"), col("price").alias("preco"),
             col("freight_value").alias("valor_frete"), col("order_status").alias("status_pedido")
-        )
+        ))
 
     def _run_data_quality_checks(self):
         self.logger.info("Iniciando verificação de qualidade dos dados (Data Quality Checks)...")
         for name, df in self.dimensional_models.items():
             if name.startswith("Dim_"):
                 pk = f"id_{name.split('_')[1].lower()}"
-                if df.filter(col(pk).isNull()).count() > 0: raise ValueError(f"DQ FALHOU: {name} contém chaves primárias nulas.")
-                if df.count() != df.select(pk).distinct().count(): raise ValueError(f"DQ FALHOU: Chave primária de {name} não é única.")
+                row = df.agg(
+                    count(when(col(pk).isNull(), 1)).alias("nulos"), count(lit(1)).alias("total"), countDistinct(pk).alias("distintos")
+                ).first()
+                if row.nulos > 0: raise ValueError(f"DQ FALHOU: {name} contém chaves primárias nulas.")
+                if row.total != row.distintos: raise ValueError(f"DQ FALHOU: Chave primária de {name} não é única.")
         
-        self._check_referential_integrity("Fato_Vendas", "id_produto", "Dim_Produto", "id_produto")
-        self._check_accepted_values("Fato_Vendas", "status_pedido", self.config["data_quality"]["accepted_order_status"])
-        self._check_non_negative("Fato_Vendas", "preco")
+        self._check_referential_integrity("Fato_Vendas", {"id_produto": "Dim_Produto", "id_cliente": "Dim_Cliente", "id_vendedor": "Dim_Vendedor", "id_tempo": "Dim_Tempo"})
+        self._check_fact_values("Fato_Vendas", "status_pedido", self.config["data_quality"]["accepted_order_status"], "preco")
         self.logger.info("Verificação de qualidade dos dados concluída com sucesso.")
 
-    def _check_referential_integrity(self, fact_name, fk, dim_name, pk):
+    def _check_referential_integrity(self, fact_name, foreign_keys: Dict[str, str]):
         fact_df = self.dimensional_models[fact_name]
-        dim_df = self.dimensional_models[dim_name]
-        bad_records = fact_df.join(dim_df, fact_df[fk] == dim_df[pk], "left_anti").count()
-        if bad_records > 0: raise ValueError(f"DQ FALHOU: {bad_records} registros em {fact_name} violam a integridade referencial com {dim_name}.")
-
-    def _check_accepted_values(self, table_name, column_name, accepted_values: List[str]):
-        df = self.dimensional_models[table_name]
-        bad_records = df.filter(~col(column_name).isin(accepted_values)).count()
-        if bad_records > 0: raise ValueError(f"DQ FALHOU: {bad_records} registros em {table_name} têm valores inválidos na coluna {column_name}.")
+        row = fact_df.agg(*[count(when(col(fk).isNull(), 1)).alias(fk) for fk in foreign_keys]).first()
+        for fk, dim_name in foreign_keys.items():
+            if row[fk] > 0: raise ValueError(f"DQ FALHOU: {row[fk]} registros em {fact_name} violam a integridade referencial com {dim_name}.")
 
-    def _check_non_negative(self, table_name, column_name):
+    def _check_fact_values(self, table_name, status_column, accepted_values: List[str], non_negative_column):
         df = self.dimensional_models[table_name]
-        bad_records = df.filter(col(column_name) < 0).count()
-        if bad_records > 0: raise ValueError(f"DQ FALHOU: {bad_records} registros em {table_name} têm valores negativos em {column_name}.")
+        row = df.agg(
+            count(when(~col(status_column).isin(accepted_values), 1)).alias("valores_invalidos"),
+            count(when(col(non_negative_column) < 0, 1)).alias("valores_negativos")
+        ).first()
+        if row.valores_invalidos > 0: raise ValueError(f"DQ FALHOU: {row.valores_invalidos} registros em {table_name} têm valores inválidos na coluna {status_column}.")
+        if row.valores_negativos > 0: raise ValueError(f"DQ FALHOU: {row.valores_negativos} registros em {table_name} têm valores negativos em {non_negative_column}.")
 
     def _run_data_profiling(self):
         self.logger.info("Executando perfil de dados (Data Profiling)...")
@@ -183,17 +249,26 @@ class AdvancedStarSchemaPipeline:
         os.makedirs(profiling_path, exist_ok=True)
         
         fato_df = self.dimensional_models["Fato_Vendas"]
-        profile = fato_df.select("preco", "valor_frete").summary("count", "mean", "stddev", "min", "max").toJSON().collect()
+        stats = {"count": count, "mean": avg, "stddev": stddev, "min": min, "max": max}
+        columns = ["preco", "valor_frete"]
+        row = fato_df.agg(*[fn(c).alias(f"{c}_{stat}") for c in columns for stat, fn in stats.items()]).first().asDict()
+        profile = {c: {stat: row[f"{c}_{stat}"] for stat in stats} for c in columns}
         
         with open(os.path.join(profiling_path, "Fato_Vendas_profile.json"), 'w') as f:
-            f.write(str(profile))
+            json.dump(profile, f, indent=2)
         self.logger.info("Relatório de perfil de dados salvo.")
 
     def _save_models(self):
         self.logger.info("Salvando modelos dimensionais em formato Parquet...")
         output_path = self.config["data"]["output_path"]
         for name, df in self.dimensional_models.items():
-            df.write.mode("overwrite").parquet(os.path.join(output_path, name))
+            if name.startswith("Dim_"): df = df.coalesce(1)
+            else: df = df.repartition(self.config.get("write", {}).get("fact_partitions", 8), "id_tempo")
+            df.write.mode("overwrite") \
+                .option("compression", "snappy") \
+                .option("parquet.block.size", 128 * 1024 * 1024) \
+                .option("parquet.enable.dictionary", "true") \
+                .parquet(os.path.join(output_path, name))
 
     def run(self, schemas: Dict[str, StructType]):
         self.logger.info("--- INICIANDO PIPELINE DE CONSTRUÇÃO DO STAR SCHEMA ---")
@@ -210,6 +285,7 @@ class AdvancedStarSchemaPipeline:
             self.logger.critical(f"--- FALHA NA EXECUÇÃO DO PIPELINE: {e} ---", exc_info=True)
             sys.exit(1)
         finally:
+            self._unpersist_models()
             self.spark.stop()
             self.logger.info("SparkSession finalizada.")
 